@@ -0,0 +1,244 @@
+import collections
+import dataclasses
+import hashlib
+import http.server
+import io
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+import PIL.Image
+
+_LISTINGS_PER_PAGE = 24
+_FIRST_LISTING_ID = 100_000_000
+# Roughly King's Cross.
+_CENTRE_LATITUDE = 51.5308
+_CENTRE_LONGITUDE = -0.1238
+_LAST_MODIFIED = "Mon, 01 Jan 2024 00:00:00 GMT"
+
+
+@dataclasses.dataclass(frozen=True)
+class FakeServicesConfig:
+    num_listings: int
+    images_per_listing: int = 4
+    # Images are 4:3 JPEGs of this width.
+    image_width: int = 320
+    listing_page_bytes: int = 100_000
+    # Fraction of listings which are re-listings of an earlier listing, with the same location and
+    # photos but a different agent and price. Their photos are re-encoded, as when an agent
+    # re-uploads them, so they're similar but not byte-for-byte identical.
+    duplicate_rate: float = 0.0
+    # Added to every response.
+    latency_secs: float = 0.0
+    # Fraction of requests answered with a 503.
+    error_rate: float = 0.0
+    # Requests beyond this many in any one-second window are answered with a 429.
+    max_requests_per_sec: int | None = None
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    server: "_Server"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        config = self.server.config
+        time.sleep(config.latency_secs)
+        url = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        if self.server.is_throttled():
+            if url.path == "/maps/api/distancematrix/json":
+                # The Distance Matrix API signals throttling in the response body.
+                self._send_json({"status": "OVER_QUERY_LIMIT"})
+            else:
+                self._send(429, b"Too Many Requests", "text/plain")
+        elif random.random() < config.error_rate:
+            self._send(503, b"Service Unavailable", "text/plain")
+        elif url.path == "/api/_search":
+            self._send_json(self._search_page(int(params["index"][0])))
+        elif match := re.fullmatch(r"/properties/(\d+)", url.path):
+            listing_page = self._listing_page(int(match.group(1)))
+            self._send_cacheable(listing_page, "text/html")
+        elif match := re.fullmatch(r"/images/(\d+)_(\d+)\.jpeg", url.path):
+            image = self._image(int(match.group(1)), int(match.group(2)))
+            self._send_cacheable(image, "image/jpeg")
+        elif url.path == "/maps/api/distancematrix/json":
+            latlngs = params["destinations"][0].split("|")
+            self._send_json(self._distance_matrix(latlngs))
+        else:
+            self._send(404, b"Not Found", "text/plain")
+
+    def _send(
+        self,
+        status: int,
+        content: bytes,
+        content_type: str,
+        extra_headers: dict[str, str] | None = None,
+    ):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _send_cacheable(self, content: bytes, content_type: str):
+        # Content never changes, so conditional requests can always be answered with a 304.
+        etag = f'"{hashlib.sha256(content).hexdigest()[:16]}"'
+        headers = {"ETag": etag, "Last-Modified": _LAST_MODIFIED}
+        if self.headers.get("If-None-Match") == etag:
+            self._send(304, b"", content_type, headers)
+        else:
+            self._send(200, content, content_type, headers)
+
+    def _send_json(self, obj: dict):
+        self._send(200, json.dumps(obj).encode(), "application/json")
+
+    def _search_page(self, listing_index: int) -> dict:
+        num_listings = self.server.config.num_listings
+        listing_nums = range(
+            listing_index, min(listing_index + _LISTINGS_PER_PAGE, num_listings)
+        )
+        pagination = {"total": -(-num_listings // _LISTINGS_PER_PAGE)}
+        if listing_index + _LISTINGS_PER_PAGE < num_listings:
+            pagination["next"] = str(listing_index + _LISTINGS_PER_PAGE)
+        return {
+            "properties": [self._listing_dict(n) for n in listing_nums],
+            "resultCount": f"{num_listings:,}",
+            "pagination": pagination,
+        }
+
+    def _original_listing_num(self, listing_num: int) -> int:
+        rng = random.Random(f"duplicate_{listing_num}")
+        if listing_num > 0 and rng.random() < self.server.config.duplicate_rate:
+            return self._original_listing_num(rng.randrange(listing_num))
+        return listing_num
+
+    def _listing_dict(self, listing_num: int) -> dict:
+        listing_id = _FIRST_LISTING_ID + listing_num
+        rng = random.Random(listing_id)
+        price = rng.randrange(1000, 3000)
+        location_rng = random.Random(self._original_listing_num(listing_num))
+        host = f"http://{self.headers['Host']}"
+        return {
+            "id": listing_id,
+            "displayAddress": f"Flat {listing_num}, Fake Street, London",
+            "location": {
+                "latitude": _CENTRE_LATITUDE + location_rng.uniform(-0.05, 0.05),
+                "longitude": _CENTRE_LONGITUDE + location_rng.uniform(-0.05, 0.05),
+            },
+            "propertyImages": {
+                "images": [
+                    {"srcUrl": f"{host}/images/{listing_id}_{image_num}.jpeg"}
+                    for image_num in range(self.server.config.images_per_listing)
+                ]
+            },
+            "price": {
+                "amount": price,
+                "displayPrices": [{"displayPrice": f"£{price:,} pcm"}],
+            },
+            "addedOrReduced": "Added today",
+            "customer": {"branchDisplayName": f"Agent {rng.randrange(20)}"},
+        }
+
+    def _listing_page(self, listing_id: int) -> bytes:
+        description = json.dumps("A lovely flat. Minimum 6 month term.")
+        html = (
+            "<html><body>"
+            "<dl><dt>Min. tenancy: </dt><dd>6 months</dd></dl>"
+            f'<script>{{"description":{description},"id":{listing_id}}}</script>'
+        )
+        padding = "x" * max(0, self.server.config.listing_page_bytes - len(html))
+        return (html + padding + "</body></html>").encode()
+
+    def _photo(self, original_listing_num: int, image_num: int) -> PIL.Image.Image:
+        rng = random.Random(f"{original_listing_num}_{image_num}")
+        width = self.server.config.image_width
+        height = width * 3 // 4
+        # Coarse random blocks of colour, smoothed out, give each photo a distinct structure for
+        # perceptual hashing. The fine noise on top makes it compress like a real photo.
+        blocks = PIL.Image.frombytes("RGB", (8, 6), rng.randbytes(8 * 6 * 3))
+        photo = blocks.resize((width, height), PIL.Image.Resampling.BICUBIC)
+        noise = PIL.Image.frombytes(
+            "RGB", (width, height), rng.randbytes(width * height * 3)
+        )
+        return PIL.Image.blend(photo, noise, alpha=0.1)
+
+    def _image(self, listing_id: int, image_num: int) -> bytes:
+        listing_num = listing_id - _FIRST_LISTING_ID
+        original_listing_num = self._original_listing_num(listing_num)
+        photo = self._photo(original_listing_num, image_num)
+        quality = 85
+        if listing_num != original_listing_num:
+            # Re-listed photos are slightly resized and compressed differently.
+            rng = random.Random(f"reencode_{listing_num}_{image_num}")
+            scale = rng.uniform(0.8, 1.0)
+            photo = photo.resize(
+                (round(photo.width * scale), round(photo.height * scale)),
+                PIL.Image.Resampling.BILINEAR,
+            )
+            quality = rng.randrange(60, 95)
+        output = io.BytesIO()
+        photo.save(output, format="JPEG", quality=quality)
+        return output.getvalue()
+
+    def _distance_matrix(self, latlngs: list[str]) -> dict:
+        elements = []
+        for latlng in latlngs:
+            rng = random.Random(latlng)
+            elements.append(
+                {
+                    "status": "OK",
+                    "distance": {"value": rng.randrange(1_000, 15_000)},
+                    "duration": {"value": rng.randrange(10 * 60, 50 * 60)},
+                }
+            )
+        return {"status": "OK", "rows": [{"elements": elements}]}
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, config: FakeServicesConfig):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.config = config
+        self._lock = threading.Lock()
+        self._recent_request_times = collections.deque()
+
+    def is_throttled(self) -> bool:
+        if self.config.max_requests_per_sec is None:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            while (
+                self._recent_request_times and self._recent_request_times[0] < now - 1
+            ):
+                self._recent_request_times.popleft()
+            if len(self._recent_request_times) >= self.config.max_requests_per_sec:
+                return True
+            self._recent_request_times.append(now)
+            return False
+
+
+class FakeServices:
+    def __init__(self, config: FakeServicesConfig):
+        self._server = _Server(config)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "FakeServices":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
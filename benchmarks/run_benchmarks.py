@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+import argparse
+import contextlib
+import json
+import os
+import pathlib
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_services import FakeServices, FakeServicesConfig
+
+_MAIN_PATH = pathlib.Path(__file__).resolve().parent.parent / "main.py"
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--num_listings", type=str, default="100,1000,10000")
+parser.add_argument("--images_per_listing", type=int, default=4)
+parser.add_argument("--image_width", type=int, default=320)
+parser.add_argument("--listing_page_bytes", type=int, default=100_000)
+parser.add_argument("--duplicate_rate", type=float, default=0.0)
+parser.add_argument("--latency_ms", type=float, default=50.0)
+parser.add_argument("--error_rate", type=float, default=0.0)
+parser.add_argument("--max_requests_per_sec", type=int, default=None)
+parser.add_argument("--main_args", type=str, default="")
+# After the cold run, expire everything in the caches and run again, so that listing pages and
+# images are revalidated with conditional requests.
+parser.add_argument("--revalidation_run", action=argparse.BooleanOptionalAction)
+parser.add_argument("--output_path", type=pathlib.Path, default="benchmarks.json")
+args = parser.parse_args()
+
+
+def expire_caches(path: pathlib.Path) -> None:
+    # File cache entries' mtimes record when they were stored, as do SQLite caches' stored_time.
+    a_year_ago = time.time() - 365 * 24 * 60 * 60
+    for entry_path in (path / "caches").glob("*/*"):
+        os.utime(entry_path, (a_year_ago, a_year_ago))
+    for database_path in (path / "caches").glob("*.sqlite"):
+        with contextlib.closing(sqlite3.connect(database_path)) as connection:
+            with connection:
+                connection.execute("UPDATE entries SET stored_time = ?", (a_year_ago,))
+
+
+def run_main(env: dict[str, str], cwd: pathlib.Path) -> dict:
+    report_path = cwd / "run_report.json"
+    start_time = time.perf_counter()
+    subprocess.run(
+        [
+            sys.executable,
+            _MAIN_PATH,
+            "--rent_or_buy=buy",
+            "--min_price=0",
+            "--max_price=1000000",
+            "--work_address=10 Downing Street",
+            f"--metrics_json_path={report_path}",
+            *args.main_args.split(),
+        ],
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        check=True,
+    )
+    # Unlike the sum of the stages' times, this includes everything from interpreter startup to
+    # writing the report.
+    total_wall_time_secs = time.perf_counter() - start_time
+    return {
+        "total_wall_time_secs": total_wall_time_secs,
+        **json.loads(report_path.read_text()),
+    }
+
+
+def run_benchmark(num_listings: int) -> dict[str, dict]:
+    config = FakeServicesConfig(
+        num_listings=num_listings,
+        images_per_listing=args.images_per_listing,
+        image_width=args.image_width,
+        listing_page_bytes=args.listing_page_bytes,
+        duplicate_rate=args.duplicate_rate,
+        latency_secs=args.latency_ms / 1000,
+        error_rate=args.error_rate,
+        max_requests_per_sec=args.max_requests_per_sec,
+    )
+    with FakeServices(config) as fake_services, tempfile.TemporaryDirectory() as tmp:
+        env = {
+            **os.environ,
+            "RIGHTMOVE_URL": fake_services.url,
+            "GOOGLE_MAPS_URL": fake_services.url,
+            "GOOGLE_MAPS_API_KEY": "AIzaFakeKeyForBenchmarks",
+        }
+        # Run in a fresh directory so that every benchmark starts with empty caches.
+        report_by_run = {"cold": run_main(env, pathlib.Path(tmp))}
+        if args.revalidation_run:
+            expire_caches(pathlib.Path(tmp))
+            report_by_run["revalidation"] = run_main(env, pathlib.Path(tmp))
+        return report_by_run
+
+
+def format_secs(secs: float | None) -> str:
+    # With --pipeline, stages other than the pipeline as a whole have no wall or CPU time.
+    return f"{secs:8.2f}" if secs is not None else f"{'-':>8}"
+
+
+def print_report(num_listings: int, run: str, report: dict) -> None:
+    print(
+        f"\n{num_listings} listings ({run} run): {report['total_wall_time_secs']:.1f} s, "
+        f"peak memory {report['peak_rss_bytes'] / 2**20:.0f} MiB"
+    )
+    for stage, stats in report["stages"].items():
+        print(
+            f"  {stage:<14}"
+            f"{format_secs(stats['wall_time_secs'])} s wall"
+            f"{format_secs(stats['cpu_time_secs'])} s CPU"
+            f"{stats['busy_time_secs']:8.2f} s busy"
+            f"{stats['num_requests']:8} requests"
+            f"{stats['num_retries']:6} retries"
+            f"{stats['bytes_transferred'] / 2**20:9.1f} MiB"
+            f"{stats['bytes_saved'] / 2**20:9.1f} MiB saved"
+        )
+
+
+def main():
+    report_by_num_listings = {}
+    for num_listings in [int(n) for n in args.num_listings.split(",")]:
+        report_by_run = run_benchmark(num_listings)
+        for run, report in report_by_run.items():
+            print_report(num_listings, run, report)
+        report_by_num_listings[num_listings] = report_by_run
+    args.output_path.write_text(json.dumps(report_by_num_listings, indent=2))
+    print(f"\nWrote results to {args.output_path}")
+
+
+if __name__ == "__main__":
+    main()
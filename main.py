@@ -2,10 +2,17 @@
 
 import argparse
 import json
+import pathlib
 import re
+from typing import Iterable, Iterator
+
+import tqdm
 
 from utils import commute_utils
+from utils import dedup_utils
 from utils import html_utils
+from utils import metrics_utils
+from utils import pipeline_utils
 from utils import scraping_utils
 from utils import types
 
@@ -22,14 +29,24 @@ parser.add_argument("--sort_order", choices=["asc", "desc"], default="asc")
 parser.add_argument("--discard_agents", type=str, default="")
 parser.add_argument("--min_tenancy_months", type=int, default=None)
 parser.add_argument("--use_raw_data_cache", action=argparse.BooleanOptionalAction)
+parser.add_argument(
+    "--group_duplicates", action=argparse.BooleanOptionalAction, default=True
+)
 parser.add_argument("--work_address", type=str, required=True)
 parser.add_argument(
     "--max_days_since_added_or_reduced",
     type=int,
     choices=[1, 3, 7, 14],
 )
+# Rather than running each stage for all listings before starting the next, pass each listing on to
+# the next stage as soon as it's ready.
+parser.add_argument("--pipeline", action=argparse.BooleanOptionalAction)
+parser.add_argument("--metrics_json_path", type=pathlib.Path, default="run_report.json")
+parser.add_argument("--metrics_prometheus_path", type=pathlib.Path, default=None)
 args = parser.parse_args()
 
+_NUM_DUPLICATE_IMAGES = 3
+
 
 def extract_price_str(listing_dict: types.ListingDict) -> str:
     if args.rent_or_buy == "buy":
@@ -49,41 +66,43 @@ def parse_listings(
     listing_dicts: list[types.ListingDict],
     listing_html_by_listing_id: dict[types.ListingID, str],
 ) -> list[types.ListingStage1]:
-    minimum_months_by_listing_id = {
-        listing_id: extract_minimum_months(listing_id, listing_html)
-        for listing_id, listing_html in listing_html_by_listing_id.items()
-    }
-
     listings: list[types.ListingStage1] = []
     processed_listing_ids = set()
     for listing_dict in listing_dicts:
         listing_id = types.ListingID(int(listing_dict["id"]))
         if listing_id in processed_listing_ids:
             continue
-        title = listing_dict["displayAddress"]
-        listing_url = f"https://www.rightmove.co.uk/properties/{listing_dict['id']}"
-        location = listing_dict["location"]
-        latlng = f"{location['latitude']},{location['longitude']}"
         listings.append(
-            types.ListingStage1(
-                listing_id=listing_id,
-                image_urls=[
-                    im["srcUrl"] for im in listing_dict["propertyImages"]["images"]
-                ],
-                title=title,
-                price_str=extract_price_str(listing_dict),
-                listing_url=listing_url,
-                latlng=latlng,
-                added_or_reduced=listing_dict["addedOrReduced"],
-                tenancy_minimum_months=minimum_months_by_listing_id[listing_id],
-                agent=listing_dict["customer"]["branchDisplayName"],
-            )
+            parse_listing(listing_dict, listing_html_by_listing_id[listing_id])
         )
         processed_listing_ids.add(listing_id)
 
     return listings
 
 
+@metrics_utils.busy(metrics_utils.PARSING)
+def parse_listing(
+    listing_dict: types.ListingDict, listing_html: str
+) -> types.ListingStage1:
+    listing_id = types.ListingID(int(listing_dict["id"]))
+    title = listing_dict["displayAddress"]
+    listing_url = f"https://www.rightmove.co.uk/properties/{listing_dict['id']}"
+    location = listing_dict["location"]
+    latlng = f"{location['latitude']},{location['longitude']}"
+    return types.ListingStage1(
+        listing_id=listing_id,
+        image_urls=[im["srcUrl"] for im in listing_dict["propertyImages"]["images"]],
+        title=title,
+        price_str=extract_price_str(listing_dict),
+        listing_url=listing_url,
+        latlng=latlng,
+        added_or_reduced=listing_dict["addedOrReduced"],
+        tenancy_minimum_months=extract_minimum_months(listing_id, listing_html),
+        agent=listing_dict["customer"]["branchDisplayName"],
+        duplicate_listings=[],
+    )
+
+
 def extract_listing_descriptions(listing_html) -> str:
     re_match = re.search(r'"description":(.*?[^\\]"),', listing_html)
     assert re_match is not None, breakpoint()
@@ -98,7 +117,7 @@ def extract_minimum_months(
 
     match1 = re.search(r"Min\. tenancy: </dt><dd>(\d+) months", listing_html)
     if match1:
-        return match1.group(1)
+        return int(match1.group(1))
 
     # Otherwise, look for a mention of the minimum tenancy in the listing description.
 
@@ -151,75 +170,68 @@ def extract_minimum_months(
     return None
 
 
-def main():
-    # Scrape or load raw data.
-    search_params = types.SearchParams(
-        {
-            "locationIdentifier": "REGION^87399",  # King's Cross.
-            "minBedrooms": 0,
-            "maxBedrooms": 0,
-            "minPrice": args.min_price,
-            "maxPrice": args.max_price,
-            "radius": 5.0,  # Miles.
-            "channel": "RENT" if "rent" in args.rent_or_buy else "BUY",
-            "currencyCode": "GBP",
-            "numPropertiesPerPage": 24,  # Not sure whether this matters.
-            "propertyTypes": ["flat"],
-            "dontShow": ["sharedOwnership"],
-            "furnishType": [
-                "furnished" if "rent" in args.rent_or_buy else "unfurnished"
-            ],
-        }
+def meets_tenancy_requirement(listing: types.ListingStage1) -> bool:
+    if not args.min_tenancy_months:
+        return True
+    return bool(
+        listing.tenancy_minimum_months
+        and listing.tenancy_minimum_months <= args.min_tenancy_months
     )
-    if args.max_days_since_added_or_reduced is not None:
-        # Annoyingly, this field can't be used to specify filtering by added/reduced independently.
-        # We could filter manually based on the response field 'firstVisibleDate', but it doesn't always seem to line up
-        # with the response field 'addedOrReduced' - sometimes it's earlier, sometimes later. I assume addedOrReduced
-        # is more likely to be correct?
-        search_params["maxDaysSinceAdded"] = args.max_days_since_added_or_reduced
-    if args.rent_or_buy == "short_term_rent":
-        search_params["letType"] = "shortTerm"
-    elif args.rent_or_buy == "long_term_rent":
-        search_params["letType"] = "longTerm"
 
+
+def meets_agent_requirement(listing: types.ListingStage1) -> bool:
+    if not args.discard_agents:
+        return True
+    discard_agents = args.discard_agents.split(",")
+    return not any(
+        agent_substring in listing.agent.lower() for agent_substring in discard_agents
+    )
+
+
+def fetch_first_images(listing: types.ListingStage1) -> list[bytes]:
+    return scraping_utils.fetch_first_images(listing, _NUM_DUPLICATE_IMAGES)
+
+
+def run_stages(search_params: types.SearchParams) -> list[types.ListingStage3]:
     if args.use_raw_data_cache:
         raw_scrape_data = scraping_utils.load_raw_data_cache(search_params)
     else:
         raw_scrape_data = scraping_utils.scrape_raw_data(search_params)
         scraping_utils.save_raw_data_cache(raw_scrape_data)
+        scraping_utils.clear_cached_results_pages(search_params)
 
     # Convert raw data to a more structured form.
-    listings = parse_listings(
-        raw_scrape_data.listing_dicts,
-        raw_scrape_data.listing_html_by_listing_id,
-    )
+    with metrics_utils.timed(metrics_utils.PARSING):
+        listings = parse_listings(
+            raw_scrape_data.listing_dicts,
+            raw_scrape_data.listing_html_by_listing_id,
+        )
     print(f"Got {len(listings)} listings\n")
 
     # Filter listings based on minimum tenancy.
     if args.min_tenancy_months:
         listings = [
-            listing
-            for listing in listings
-            if listing.tenancy_minimum_months
-            and listing.tenancy_minimum_months <= args.min_tenancy_months
+            listing for listing in listings if meets_tenancy_requirement(listing)
         ]
         print(f"{len(listings)} listings left after filtering by minimum tenancy\n")
 
     # Filter listings based on estate agents.
     if args.discard_agents:
-        discard_agents = args.discard_agents.split(",")
-        listings = [
-            listing
-            for listing in listings
-            if not any(
-                agent_substring in listing.agent.lower()
-                for agent_substring in discard_agents
-            )
-        ]
+        listings = [listing for listing in listings if meets_agent_requirement(listing)]
         print(f"{len(listings)} listing left after filtering by agents\n")
 
+    # Collapse the same property listed by several agents into one listing, so that we only
+    # fetch commutes and images once for it.
+    if args.group_duplicates:
+        with metrics_utils.timed(metrics_utils.DEDUPLICATION):
+            listings = dedup_utils.group_duplicate_listings(
+                listings, fetch_first_images
+            )
+        print(f"{len(listings)} listings left after grouping duplicates\n")
+
     # Filter listings based on --min_commute_mins and --max_commute_mins.
-    listings = commute_utils.add_commutes(listings, args.work_address)
+    with metrics_utils.timed(metrics_utils.COMMUTES):
+        listings = commute_utils.add_commutes(listings, args.work_address)
     listings = commute_utils.filter_commutes(
         listings,
         min_commute_mins=args.min_commute_mins,
@@ -230,7 +242,143 @@ def main():
     print(f"Found {len(listings)} listings matching requirements\n")
 
     # Populate images.
-    listings = scraping_utils.add_images(listings)
+    with metrics_utils.timed(metrics_utils.IMAGES):
+        listings = scraping_utils.add_images(listings)
+
+    return listings
+
+
+def run_pipeline(search_params: types.SearchParams) -> list[types.ListingStage3]:
+    # Each stage runs in its own thread(s), passing listings on through bounded buffers, so that
+    # e.g. commutes for the first listings are fetched while later search pages are still loading.
+    if args.use_raw_data_cache:
+        raw_scrape_data = scraping_utils.load_raw_data_cache(search_params)
+        listing_dicts_and_html = (
+            (
+                listing_dict,
+                raw_scrape_data.listing_html_by_listing_id[
+                    types.ListingID(int(listing_dict["id"]))
+                ],
+            )
+            for listing_dict in unique_listing_dicts(raw_scrape_data.listing_dicts)
+        )
+    else:
+        raw_scrape_data = types.RawScrapeData(
+            search_params=search_params,
+            listing_dicts=[],
+            listing_html_by_listing_id={},
+        )
+        listing_dicts = pipeline_utils.buffered(
+            scraping_utils.iter_listing_dicts(search_params)
+        )
+        listing_dicts_and_html = pipeline_utils.parallel_map(
+            lambda listing_dict: (
+                listing_dict,
+                scraping_utils.fetch_listing_page(
+                    types.ListingID(int(listing_dict["id"]))
+                ),
+            ),
+            unique_listing_dicts(listing_dicts),
+        )
+
+    def iter_listings() -> Iterator[types.ListingStage1]:
+        for listing_dict, listing_html in listing_dicts_and_html:
+            if listing_html is None:
+                # Couldn't fetch the listing's page.
+                continue
+            listing = parse_listing(listing_dict, listing_html)
+            if not args.use_raw_data_cache:
+                raw_scrape_data.listing_dicts.append(listing_dict)
+                raw_scrape_data.listing_html_by_listing_id[
+                    listing.listing_id
+                ] = listing_html
+            if meets_tenancy_requirement(listing) and meets_agent_requirement(listing):
+                yield listing
+
+    listings = iter_listings()
+
+    if args.group_duplicates:
+        listings = dedup_utils.iter_group_duplicate_listings(
+            listings, fetch_first_images
+        )
+
+    listings_with_commutes = pipeline_utils.buffered(
+        commute_utils.iter_add_commutes(listings, args.work_address)
+    )
+    listings_with_commutes = (
+        listing
+        for listing in listings_with_commutes
+        if commute_utils.meets_commute_requirements(
+            listing,
+            min_commute_mins=args.min_commute_mins,
+            max_commute_mins=args.max_commute_mins,
+        )
+    )
+    listings_with_images = pipeline_utils.parallel_map(
+        scraping_utils.add_listing_images, listings_with_commutes
+    )
+    listings = list(tqdm.tqdm(listings_with_images, desc="Listings"))
+    print(f"Found {len(listings)} listings matching requirements\n")
+
+    if not args.use_raw_data_cache:
+        scraping_utils.save_raw_data_cache(raw_scrape_data)
+        scraping_utils.clear_cached_results_pages(search_params)
+
+    return listings
+
+
+def unique_listing_dicts(
+    listing_dicts: Iterable[types.ListingDict],
+) -> Iterator[types.ListingDict]:
+    # Search results can shift between pages while we're paging through them, so the same listing
+    # can turn up twice. Skip repeats before fetching their pages.
+    listing_ids = set()
+    for listing_dict in listing_dicts:
+        if listing_dict["id"] not in listing_ids:
+            listing_ids.add(listing_dict["id"])
+            yield listing_dict
+
+
+def main():
+    # Caches from before caches/ existed.
+    scraping_utils.import_legacy_caches()
+    commute_utils.import_legacy_cache(args.work_address)
+
+    # Scrape or load raw data.
+    search_params = types.SearchParams(
+        {
+            "locationIdentifier": "REGION^87399",  # King's Cross.
+            "minBedrooms": 0,
+            "maxBedrooms": 0,
+            "minPrice": args.min_price,
+            "maxPrice": args.max_price,
+            "radius": 5.0,  # Miles.
+            "channel": "RENT" if "rent" in args.rent_or_buy else "BUY",
+            "currencyCode": "GBP",
+            "numPropertiesPerPage": 24,  # Not sure whether this matters.
+            "propertyTypes": ["flat"],
+            "dontShow": ["sharedOwnership"],
+            "furnishType": [
+                "furnished" if "rent" in args.rent_or_buy else "unfurnished"
+            ],
+        }
+    )
+    if args.max_days_since_added_or_reduced is not None:
+        # Annoyingly, this field can't be used to specify filtering by added/reduced independently.
+        # We could filter manually based on the response field 'firstVisibleDate', but it doesn't always seem to line up
+        # with the response field 'addedOrReduced' - sometimes it's earlier, sometimes later. I assume addedOrReduced
+        # is more likely to be correct?
+        search_params["maxDaysSinceAdded"] = args.max_days_since_added_or_reduced
+    if args.rent_or_buy == "short_term_rent":
+        search_params["letType"] = "shortTerm"
+    elif args.rent_or_buy == "long_term_rent":
+        search_params["letType"] = "longTerm"
+
+    if args.pipeline:
+        with metrics_utils.timed(metrics_utils.PIPELINE):
+            listings = run_pipeline(search_params)
+    else:
+        listings = run_stages(search_params)
 
     # Sort listings.
     if args.sort == "price":
@@ -244,7 +392,13 @@ def main():
         listings = listings[::-1]
 
     # Write final HTML.
-    html_utils.write_html(listings)
+    with metrics_utils.timed(metrics_utils.HTML):
+        html_utils.write_html(listings)
+
+    # Write metrics.
+    metrics_utils.write_json_report(args.metrics_json_path)
+    if args.metrics_prometheus_path is not None:
+        metrics_utils.write_prometheus_textfile(args.metrics_prometheus_path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+import argparse
+
+from utils import cache_utils
+
+parser = argparse.ArgumentParser()
+parser.add_argument("command", choices=["stats", "compact"])
+args = parser.parse_args()
+
+
+def print_stats():
+    for cache in cache_utils.ALL_CACHES:
+        stats = cache.stats()
+        print(
+            f"{cache.name:<14}"
+            f"{stats.num_entries:8} entries"
+            f"{stats.num_bytes / 2**20:10.1f} MiB"
+            f"{stats.num_expired_entries:8} expired"
+        )
+
+
+def main():
+    if args.command == "compact":
+        for cache in cache_utils.ALL_CACHES:
+            num_removed = cache.compact()
+            print(f"Removed {num_removed} entries from {cache.name} cache")
+        print()
+    print_stats()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,422 @@
+import dataclasses
+import datetime
+import hashlib
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+
+from utils import metrics_utils
+
+_CACHES_PATH = pathlib.Path("caches/")
+# When a cache goes over its limits, evict down to this fraction of them, so that we don't have to
+# rescan the cache on every subsequent put.
+_EVICTION_TARGET_FRACTION = 0.9
+# Temporary files older than this were left behind by a run that was killed mid-write. Younger ones
+# may belong to a write in progress in another run.
+_STALE_TMP_FILE_AGE = datetime.timedelta(minutes=10)
+
+
+@dataclasses.dataclass(frozen=True)
+class CacheStats:
+    num_entries: int
+    num_bytes: int
+    num_expired_entries: int
+
+
+def _disk_usage(stat: os.stat_result) -> int:
+    # Files take up whole blocks on disk, so small entries use more space than their size suggests.
+    return stat.st_blocks * 512
+
+
+@dataclasses.dataclass(frozen=True)
+class _Entry:
+    path: pathlib.Path
+    num_bytes: int
+    stored_time: float
+    last_access_time: float
+
+
+class Cache:
+    # For large values, like pages and images. Each entry is a file named by the hash of its key. The file's mtime records when the entry was
+    # stored (for TTL expiry), and its atime when it was last read (for LRU eviction). Keeping this
+    # metadata in the filesystem means an interrupted run never leaves an index out of sync.
+
+    def __init__(
+        self,
+        name: str,
+        ttl: datetime.timedelta | None = None,
+        max_entries: int | None = None,
+        max_bytes: int | None = None,
+    ):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._path = _CACHES_PATH / name
+        self._lock = threading.Lock()
+        # Computed lazily, since scanning a large cache isn't free.
+        self._num_entries: int | None = None
+        self._num_bytes: int | None = None
+
+    def _entry_path(self, key: str) -> pathlib.Path:
+        return self._path / hashlib.sha256(key.encode()).hexdigest()
+
+    def _is_expired(self, stored_time: float, now: float) -> bool:
+        return self.ttl is not None and now - stored_time > self.ttl.total_seconds()
+
+    def _scan(self) -> list[_Entry]:
+        if not self._path.exists():
+            return []
+        entries = []
+        for path in self._path.iterdir():
+            if path.suffix == ".tmp":
+                continue
+            stat = path.stat()
+            entries.append(
+                _Entry(
+                    path=path,
+                    num_bytes=_disk_usage(stat),
+                    stored_time=stat.st_mtime,
+                    last_access_time=stat.st_atime,
+                )
+            )
+        return entries
+
+    def _remove_stale_tmp_files(self) -> None:
+        if not self._path.exists():
+            return
+        now = time.time()
+        for tmp_path in self._path.glob("*.tmp"):
+            try:
+                if now - tmp_path.stat().st_mtime > _STALE_TMP_FILE_AGE.total_seconds():
+                    tmp_path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def get(self, key: str) -> bytes | None:
+        path = self._entry_path(key)
+        now = time.time()
+        try:
+            stat = path.stat()
+            if self._is_expired(stat.st_mtime, now):
+                metrics_utils.record_cache_misses(self.name, 1)
+                return None
+            value = path.read_bytes()
+            os.utime(path, (now, stat.st_mtime))
+        except FileNotFoundError:
+            # Possibly evicted by another thread between the stat and the read.
+            metrics_utils.record_cache_misses(self.name, 1)
+            return None
+        metrics_utils.record_cache_hits(self.name, 1)
+        return value
+
+    def get_stale(self, key: str) -> bytes | None:
+        # Like get, but also returns expired entries, e.g. to revalidate them with the server.
+        # Doesn't count towards hits or misses.
+        try:
+            return self._entry_path(key).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def refresh(self, key: str) -> None:
+        # Marks an entry as freshly stored, e.g. after the server confirmed it's still up to date.
+        now = time.time()
+        try:
+            os.utime(self._entry_path(key), (now, now))
+        except FileNotFoundError:
+            pass
+
+    def put(self, key: str, value: bytes) -> None:
+        self._path.mkdir(parents=True, exist_ok=True)
+        path = self._entry_path(key)
+        tmp_path = path.with_name(path.name + f".{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(value)
+        num_bytes = _disk_usage(tmp_path.stat())
+        with self._lock:
+            if self._num_entries is None:
+                self._remove_stale_tmp_files()
+                self._update_totals(self._scan())
+            try:
+                old_num_bytes = _disk_usage(path.stat())
+                self._num_bytes -= old_num_bytes
+            except FileNotFoundError:
+                self._num_entries += 1
+            tmp_path.rename(path)
+            self._num_bytes += num_bytes
+            if self._is_over_limits(self._num_entries, self._num_bytes):
+                self._evict(fraction=_EVICTION_TARGET_FRACTION)
+
+    def delete(self, key: str) -> None:
+        path = self._entry_path(key)
+        with self._lock:
+            try:
+                num_bytes = _disk_usage(path.stat())
+                path.unlink()
+            except FileNotFoundError:
+                return
+            if self._num_entries is not None:
+                self._num_entries -= 1
+                self._num_bytes -= num_bytes
+
+    def _update_totals(self, entries: list[_Entry]) -> None:
+        self._num_entries = len(entries)
+        self._num_bytes = sum(entry.num_bytes for entry in entries)
+
+    def _is_over_limits(
+        self, num_entries: int, num_bytes: int, fraction: float = 1.0
+    ) -> bool:
+        return (
+            self.max_entries is not None and num_entries > self.max_entries * fraction
+        ) or (self.max_bytes is not None and num_bytes > self.max_bytes * fraction)
+
+    def _evict(self, fraction: float) -> int:
+        now = time.time()
+        entries = self._scan()
+        # Evict expired entries first, then least recently used.
+        entries.sort(
+            key=lambda entry: (
+                not self._is_expired(entry.stored_time, now),
+                entry.last_access_time,
+            )
+        )
+        num_entries = len(entries)
+        num_bytes = sum(entry.num_bytes for entry in entries)
+        num_evicted = 0
+        for entry in entries:
+            is_expired = self._is_expired(entry.stored_time, now)
+            if not is_expired and not self._is_over_limits(
+                num_entries, num_bytes, fraction
+            ):
+                break
+            entry.path.unlink()
+            num_entries -= 1
+            num_bytes -= entry.num_bytes
+            num_evicted += 1
+        self._num_entries = num_entries
+        self._num_bytes = num_bytes
+        return num_evicted
+
+    def stats(self) -> CacheStats:
+        now = time.time()
+        entries = self._scan()
+        return CacheStats(
+            num_entries=len(entries),
+            num_bytes=sum(entry.num_bytes for entry in entries),
+            num_expired_entries=sum(
+                self._is_expired(entry.stored_time, now) for entry in entries
+            ),
+        )
+
+    def compact(self) -> int:
+        # Removes expired entries and leftover temporary files, and enforces limits.
+        with self._lock:
+            self._remove_stale_tmp_files()
+            return self._evict(fraction=1.0)
+
+
+class SqliteCache:
+    # For small values, like per-URL metadata, of which there may be millions: one file per entry
+    # would waste a disk block and an inode on each. All entries live in a single SQLite database,
+    # with the same TTL expiry and LRU eviction as Cache.
+
+    def __init__(
+        self,
+        name: str,
+        ttl: datetime.timedelta | None = None,
+        max_entries: int | None = None,
+    ):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._path = _CACHES_PATH / f"{name}.sqlite"
+        self._lock = threading.Lock()
+        # Opened lazily, so that caches a run doesn't use aren't created.
+        self._connection: sqlite3.Connection | None = None
+        # Computed lazily, since counting a large table isn't free.
+        self._num_entries: int | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # Must be called with the lock held.
+        if self._connection is None:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(
+                self._path, timeout=30, isolation_level=None, check_same_thread=False
+            )
+            self._connection.execute("PRAGMA journal_mode = WAL")
+            self._connection.execute("PRAGMA synchronous = NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value BLOB, stored_time REAL, last_access_time REAL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS entries_by_last_access_time "
+                "ON entries (last_access_time)"
+            )
+        return self._connection
+
+    def _expiry_time(self, now: float) -> float:
+        # Entries stored before this time have expired.
+        if self.ttl is None:
+            return float("-inf")
+        return now - self.ttl.total_seconds()
+
+    def get(self, key: str) -> bytes | None:
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute(
+                "SELECT value FROM entries WHERE key = ? AND stored_time >= ?",
+                (key, self._expiry_time(now)),
+            ).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE entries SET last_access_time = ? WHERE key = ?", (now, key)
+                )
+        if row is None:
+            metrics_utils.record_cache_misses(self.name, 1)
+            return None
+        metrics_utils.record_cache_hits(self.name, 1)
+        return row[0]
+
+    def get_stale(self, key: str) -> bytes | None:
+        # Like get, but also returns expired entries, e.g. to revalidate them with the server.
+        # Doesn't count towards hits or misses.
+        with self._lock:
+            row = (
+                self._connect()
+                .execute("SELECT value FROM entries WHERE key = ?", (key,))
+                .fetchone()
+            )
+        return None if row is None else row[0]
+
+    def refresh(self, key: str) -> None:
+        # Marks an entry as freshly stored, e.g. after the server confirmed it's still up to date.
+        now = time.time()
+        with self._lock:
+            self._connect().execute(
+                "UPDATE entries SET stored_time = ?, last_access_time = ? WHERE key = ?",
+                (now, now, key),
+            )
+
+    def put(self, key: str, value: bytes) -> None:
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            if self._num_entries is None:
+                [self._num_entries] = connection.execute(
+                    "SELECT COUNT(*) FROM entries"
+                ).fetchone()
+            is_new = (
+                connection.execute(
+                    "SELECT 1 FROM entries WHERE key = ?", (key,)
+                ).fetchone()
+                is None
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            self._num_entries += is_new
+            if self.max_entries is not None and self._num_entries > self.max_entries:
+                self._evict(fraction=_EVICTION_TARGET_FRACTION)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            num_deleted = (
+                self._connect()
+                .execute("DELETE FROM entries WHERE key = ?", (key,))
+                .rowcount
+            )
+            if self._num_entries is not None:
+                self._num_entries -= num_deleted
+
+    def _evict(self, fraction: float) -> int:
+        # Must be called with the lock held.
+        connection = self._connect()
+        # Evict expired entries first, then least recently used.
+        num_evicted = connection.execute(
+            "DELETE FROM entries WHERE stored_time < ?",
+            (self._expiry_time(time.time()),),
+        ).rowcount
+        [num_entries] = connection.execute("SELECT COUNT(*) FROM entries").fetchone()
+        if self.max_entries is not None:
+            num_excess_entries = num_entries - int(self.max_entries * fraction)
+            if num_excess_entries > 0:
+                num_evicted += connection.execute(
+                    "DELETE FROM entries WHERE key IN ("
+                    "SELECT key FROM entries ORDER BY last_access_time LIMIT ?)",
+                    (num_excess_entries,),
+                ).rowcount
+        [self._num_entries] = connection.execute(
+            "SELECT COUNT(*) FROM entries"
+        ).fetchone()
+        return num_evicted
+
+    def stats(self) -> CacheStats:
+        if not self._path.exists():
+            return CacheStats(num_entries=0, num_bytes=0, num_expired_entries=0)
+        with self._lock:
+            num_entries, num_expired_entries = (
+                self._connect()
+                .execute(
+                    "SELECT COUNT(*), TOTAL(stored_time < ?) FROM entries",
+                    (self._expiry_time(time.time()),),
+                )
+                .fetchone()
+            )
+        # Including SQLite's write-ahead log, which holds recent writes.
+        num_bytes = sum(
+            _disk_usage(path.stat())
+            for path in self._path.parent.glob(f"{self._path.name}*")
+        )
+        return CacheStats(
+            num_entries=num_entries,
+            num_bytes=num_bytes,
+            num_expired_entries=int(num_expired_entries),
+        )
+
+    def compact(self) -> int:
+        # Removes expired entries, enforces limits, and gives freed space back to the filesystem.
+        if not self._path.exists():
+            return 0
+        with self._lock:
+            num_evicted = self._evict(fraction=1.0)
+            if num_evicted:
+                self._connect().execute("VACUUM")
+                self._connect().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            return num_evicted
+
+
+# Results of an entire scrape, for --use_raw_data_cache.
+RAW_DATA = Cache("raw_data", max_entries=5)
+# Search results pages, kept only to resume an interrupted scrape: they're deleted once the scrape
+# completes, so that the next one sees new listings.
+SEARCH_PAGES = Cache(
+    "search_pages", ttl=datetime.timedelta(hours=1), max_entries=10_000
+)
+LISTING_PAGES = Cache(
+    "listing_pages", ttl=datetime.timedelta(hours=12), max_bytes=2 * 2**30
+)
+# Images are keyed by the hash of their contents, so that identical images at different URLs
+# (e.g. the same flat listed by several agents) are only stored once.
+IMAGES = Cache("images", ttl=datetime.timedelta(days=180), max_bytes=5 * 2**30)
+IMAGE_HASHES = SqliteCache(
+    "image_hashes", ttl=datetime.timedelta(days=180), max_entries=1_000_000
+)
+COMMUTES = Cache("commutes", ttl=datetime.timedelta(days=90), max_entries=100_000)
+# ETag and Last-Modified headers by URL, for revalidating expired listing pages and images.
+VALIDATORS = SqliteCache(
+    "validators", ttl=datetime.timedelta(days=180), max_entries=1_000_000
+)
+
+ALL_CACHES = [
+    RAW_DATA,
+    SEARCH_PAGES,
+    LISTING_PAGES,
+    IMAGES,
+    IMAGE_HASHES,
+    COMMUTES,
+    VALIDATORS,
+]
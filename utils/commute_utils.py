@@ -1,54 +1,101 @@
 import dataclasses
-import itertools
 import json
 import os
 import pathlib
-from typing import Literal
+from typing import Iterable, Iterator, Literal
 
 import googlemaps
+import requests
 from googlemaps import distance_matrix
 
+from utils import cache_utils
+from utils import metrics_utils
 from utils import types
 
-_CACHE_PATH = pathlib.Path("commutes_cache.json")
+# Overridable so that benchmarks can point us at a local stand-in.
+_GOOGLE_MAPS_URL = os.environ.get("GOOGLE_MAPS_URL", "https://maps.googleapis.com")
+# Maximum number of destinations in one Distance Matrix request.
+_BATCH_SIZE = 25
+# Where commutes were cached before caches/ existed.
+_LEGACY_CACHE_PATH = pathlib.Path("commutes_cache.json")
 
 
-def _save_cache(listings: list[types.ListingStage2]):
-    _CACHE_PATH.write_text(
-        json.dumps(
-            {
-                listing_and_commutes.listing_id: {
+def _record_response(response: requests.Response, *args, **kwargs) -> None:
+    # Hooks run before the body is read, so read it first. Then count what we actually received,
+    # which may be compressed, rather than len(response.content).
+    response.content
+    metrics_utils.record_request(metrics_utils.COMMUTES, response.raw.tell())
+
+
+class _Client(googlemaps.Client):
+    # The client retries both on HTTP errors and on OVER_QUERY_LIMIT, which comes back as a 200, by
+    # calling _request again with a higher retry_counter. So count retries there rather than from
+    # the responses.
+
+    def _request(
+        self, url, params, first_request_time=None, retry_counter=0, *args, **kwargs
+    ):
+        if retry_counter > 0:
+            metrics_utils.record_retry(metrics_utils.COMMUTES)
+        return super()._request(
+            url, params, first_request_time, retry_counter, *args, **kwargs
+        )
+
+
+def _cache_key(listing_id: types.ListingID, work_address: str) -> str:
+    # Entries live for months, so make sure a new work address doesn't pick up stale commutes.
+    return json.dumps([listing_id, work_address])
+
+
+def _save_cache(listings: list[types.ListingStage2], work_address: str):
+    for listing_and_commutes in listings:
+        cache_utils.COMMUTES.put(
+            _cache_key(listing_and_commutes.listing_id, work_address),
+            json.dumps(
+                {
                     "bicycling": dataclasses.asdict(
                         listing_and_commutes.bicycling_commute
                     ),
                     "transit": dataclasses.asdict(listing_and_commutes.transit_commute),
                 }
-                for listing_and_commutes in listings
-            }
+            ).encode(),
         )
-    )
 
 
-def _load_cache(listings: list[types.ListingStage1]) -> list[types.ListingStage2]:
-    if not _CACHE_PATH.exists():
-        return []
-    commute_by_mode_by_listing_id_str = json.loads(_CACHE_PATH.read_text())
-    commute_by_mode_by_listing_id = {
-        types.ListingID(int(listing_id_str)): commute_by_mode
-        for listing_id_str, commute_by_mode in commute_by_mode_by_listing_id_str.items()
-    }
-    listings_with_commutes = []
-    for listing in listings:
-        if listing.listing_id not in commute_by_mode_by_listing_id:
-            continue
-        commute_by_mode = commute_by_mode_by_listing_id[listing.listing_id]
-        listing_with_commutes = types.ListingStage2(
-            bicycling_commute=types.Commute(**commute_by_mode["bicycling"]),
-            transit_commute=types.Commute(**commute_by_mode["transit"]),
-            **dataclasses.asdict(listing),
+def import_legacy_cache(work_address: str) -> None:
+    # Moves commutes_cache.json into caches/. It wasn't keyed by work address, and was used whatever
+    # the address, so its commutes are assumed to be to this run's. The old file is renamed rather
+    # than deleted, so this only happens once.
+    if not _LEGACY_CACHE_PATH.exists():
+        return
+    commute_by_mode_by_listing_id_str = json.loads(_LEGACY_CACHE_PATH.read_text())
+    for listing_id_str, commute_by_mode in commute_by_mode_by_listing_id_str.items():
+        cache_utils.COMMUTES.put(
+            _cache_key(types.ListingID(int(listing_id_str)), work_address),
+            json.dumps(commute_by_mode).encode(),
         )
-        listings_with_commutes.append(listing_with_commutes)
-    return listings_with_commutes
+    _LEGACY_CACHE_PATH.rename(f"{_LEGACY_CACHE_PATH}.imported")
+    print(
+        f"Imported commutes for {len(commute_by_mode_by_listing_id_str)} listings "
+        f"from {_LEGACY_CACHE_PATH}\n"
+    )
+
+
+@metrics_utils.busy(metrics_utils.COMMUTES)
+def _load_cached_listing(
+    listing: types.ListingStage1, work_address: str
+) -> types.ListingStage2 | None:
+    cached_commutes = cache_utils.COMMUTES.get(
+        _cache_key(listing.listing_id, work_address)
+    )
+    if cached_commutes is None:
+        return None
+    commute_by_mode = json.loads(cached_commutes)
+    return types.ListingStage2(
+        bicycling_commute=types.Commute(**commute_by_mode["bicycling"]),
+        transit_commute=types.Commute(**commute_by_mode["transit"]),
+        **vars(listing),
+    )
 
 
 def _compute_commute_by_mode(
@@ -56,7 +103,11 @@ def _compute_commute_by_mode(
     mode: Literal["bicycling", "transit"],
     work_address: str,
 ) -> list[types.Commute]:
-    client = googlemaps.Client(key=os.environ["GOOGLE_MAPS_API_KEY"])
+    client = _Client(
+        key=os.environ["GOOGLE_MAPS_API_KEY"],
+        requests_kwargs={"hooks": {"response": _record_response}},
+        base_url=_GOOGLE_MAPS_URL,
+    )
     response = distance_matrix.distance_matrix(
         client,
         [work_address],
@@ -77,54 +128,81 @@ def _compute_commute_by_mode(
     return commutes
 
 
-def add_commutes(
-    listings: list[types.ListingStage1],
+@metrics_utils.busy(metrics_utils.COMMUTES)
+def _add_commutes_to_chunk(
+    listings_chunk: Iterable[types.ListingStage1],
     work_address: str,
 ) -> list[types.ListingStage2]:
-    listings_with_commutes = _load_cache(listings)
-    print(f"Loaded commutes for {len(listings_with_commutes)} listings from cache")
-    cached_listing_ids = {listing.listing_id for listing in listings_with_commutes}
-    uncached_listings = [
-        listing for listing in listings if listing.listing_id not in cached_listing_ids
-    ]
-    for listings_chunk in itertools.batched(uncached_listings, n=25):
-        latlngs = [t.latlng for t in listings_chunk]
-        bicycling_commutes = _compute_commute_by_mode(
-            latlngs, "bicycling", work_address
+    latlngs = [t.latlng for t in listings_chunk]
+    bicycling_commutes = _compute_commute_by_mode(latlngs, "bicycling", work_address)
+    transit_commutes = _compute_commute_by_mode(latlngs, "transit", work_address)
+    chunk_with_commutes = [
+        types.ListingStage2(
+            bicycling_commute=bicycling,
+            transit_commute=transit,
+            **vars(listing),
         )
-        transit_commutes = _compute_commute_by_mode(latlngs, "transit", work_address)
         for listing, bicycling, transit in zip(
             listings_chunk,
             bicycling_commutes,
             transit_commutes,
-        ):
-            listings_with_commutes.append(
-                types.ListingStage2(
-                    bicycling_commute=bicycling,
-                    transit_commute=transit,
-                    **dataclasses.asdict(listing),
-                )
-            )
-    print(f"Sent {len(uncached_listings)} queries for commutes\n")
+        )
+    ]
+    # Save as we go, so that an interrupted run doesn't have to pay for these again.
+    _save_cache(chunk_with_commutes, work_address)
+    return chunk_with_commutes
+
+
+def iter_add_commutes(
+    listings: Iterable[types.ListingStage1],
+    work_address: str,
+) -> Iterator[types.ListingStage2]:
+    # Yields each listing as soon as its commutes are known: cached listings straight away, and
+    # others as soon as there are enough for a full request.
+    uncached_listings = []
+    for listing in listings:
+        listing_with_commutes = _load_cached_listing(listing, work_address)
+        if listing_with_commutes is not None:
+            yield listing_with_commutes
+            continue
+        uncached_listings.append(listing)
+        if len(uncached_listings) == _BATCH_SIZE:
+            yield from _add_commutes_to_chunk(uncached_listings, work_address)
+            uncached_listings = []
+    if uncached_listings:
+        yield from _add_commutes_to_chunk(uncached_listings, work_address)
+
+
+def add_commutes(
+    listings: list[types.ListingStage1],
+    work_address: str,
+) -> list[types.ListingStage2]:
+    listings_with_commutes = list(iter_add_commutes(listings, work_address))
     assert len(listings_with_commutes) == len(listings)
-    _save_cache(listings_with_commutes)
     return listings_with_commutes
 
 
+def meets_commute_requirements(
+    listing: types.ListingStage2,
+    min_commute_mins: int,
+    max_commute_mins: int,
+) -> bool:
+    commutes_mins = [
+        listing.bicycling_commute.duration_mins,
+        listing.transit_commute.duration_mins,
+    ]
+    return (
+        min(commutes_mins) > min_commute_mins and max(commutes_mins) < max_commute_mins
+    )
+
+
 def filter_commutes(
     listings_with_commutes: list[types.ListingStage2],
     min_commute_mins: int,
     max_commute_mins: int,
 ) -> list[types.ListingStage2]:
-    filtered_listings = []
-    for listing in listings_with_commutes:
-        commutes_mins = [
-            listing.bicycling_commute.duration_mins,
-            listing.transit_commute.duration_mins,
-        ]
-        if (
-            min(commutes_mins) > min_commute_mins
-            and max(commutes_mins) < max_commute_mins
-        ):
-            filtered_listings.append(listing)
-    return filtered_listings
+    return [
+        listing
+        for listing in listings_with_commutes
+        if meets_commute_requirements(listing, min_commute_mins, max_commute_mins)
+    ]
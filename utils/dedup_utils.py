@@ -0,0 +1,218 @@
+import dataclasses
+import hashlib
+import io
+from typing import Callable, Iterable, Iterator
+
+from utils import metrics_utils
+from utils import pipeline_utils
+from utils import types
+
+try:
+    import PIL.Image
+except ImportError:
+    # Without Pillow, we can only spot duplicates whose images are byte-for-byte identical.
+    PIL = None
+
+# Agents often drop the pin in slightly different places, so listings are bucketed into cells of
+# 0.001 degrees (roughly 100 m north-south, 70 m east-west in London), and compared with listings in
+# the same or an adjacent cell.
+_CELLS_PER_DEGREE = 1000
+# Maximum number of differing bits for two perceptual hashes to count as the same image.
+_MAX_HASH_DISTANCE = 6
+# Perceptual hashes with fewer than this many bits set, or unset, come from images with little
+# structure, e.g. blank or single-colour placeholders, and would match each other by chance.
+_MIN_HASH_BITS = 8
+# Listings are duplicates only if at least this many of their images match, and at least this
+# fraction of the images we can compare. A single shared image, e.g. an agent's logo or a photo of
+# the building's entrance, isn't enough.
+_MIN_MATCHING_IMAGES = 2
+_MIN_MATCHING_FRACTION = 2 / 3
+
+# Either a perceptual hash, or if the image couldn't be decoded, a hash of its bytes.
+_ImageHash = int | str
+# A listing's location, in units of 1 / _CELLS_PER_DEGREE degrees.
+_Cell = tuple[int, int]
+
+
+def _get_cell(latlng: str) -> _Cell:
+    lat, lng = latlng.split(",")
+    return (
+        round(float(lat) * _CELLS_PER_DEGREE),
+        round(float(lng) * _CELLS_PER_DEGREE),
+    )
+
+
+def _get_nearby_cells(cell: _Cell) -> list[_Cell]:
+    # So that two pins a metre apart either side of a cell boundary are still compared.
+    lat_cell, lng_cell = cell
+    return [
+        (lat_cell + lat_offset, lng_cell + lng_offset)
+        for lat_offset in (-1, 0, 1)
+        for lng_offset in (-1, 0, 1)
+    ]
+
+
+def _hash_image(image_bytes: bytes) -> _ImageHash:
+    if PIL is not None:
+        try:
+            image = PIL.Image.open(io.BytesIO(image_bytes))
+            # A difference hash: compare the brightness of horizontally adjacent pixels on a 9x8 thumbnail.
+            pixels = list(image.convert("L").resize((9, 8)).getdata())
+        except (OSError, ValueError, PIL.Image.DecompressionBombError):
+            # E.g. not an image format Pillow recognises, or a malformed or huge image.
+            pass
+        else:
+            image_hash = 0
+            for row in range(8):
+                for col in range(8):
+                    left, right = pixels[row * 9 + col], pixels[row * 9 + col + 1]
+                    image_hash = image_hash << 1 | (left < right)
+            return image_hash
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def _is_informative(image_hash: _ImageHash) -> bool:
+    if isinstance(image_hash, int):
+        return _MIN_HASH_BITS <= image_hash.bit_count() <= 64 - _MIN_HASH_BITS
+    return True
+
+
+def _is_same_image(hash1: _ImageHash, hash2: _ImageHash) -> bool:
+    if isinstance(hash1, int) and isinstance(hash2, int):
+        return (hash1 ^ hash2).bit_count() <= _MAX_HASH_DISTANCE
+    return hash1 == hash2
+
+
+def _is_same_listing(hashes1: list[_ImageHash], hashes2: list[_ImageHash]) -> bool:
+    hashes1 = [image_hash for image_hash in hashes1 if _is_informative(image_hash)]
+    hashes2 = [image_hash for image_hash in hashes2 if _is_informative(image_hash)]
+    num_compared = min(len(hashes1), len(hashes2))
+    # Each image can only match one other, so that e.g. one photo can't match several near-identical
+    # photos of the same room.
+    num_matching = 0
+    unmatched_hashes2 = list(hashes2)
+    for hash1 in hashes1:
+        for hash2 in unmatched_hashes2:
+            if _is_same_image(hash1, hash2):
+                unmatched_hashes2.remove(hash2)
+                num_matching += 1
+                break
+    return (
+        num_matching >= _MIN_MATCHING_IMAGES
+        and num_matching >= num_compared * _MIN_MATCHING_FRACTION
+    )
+
+
+def _get_nearby_listings(
+    listings_by_cell: dict[_Cell, list[types.ListingStage1]], cell: _Cell
+) -> list[types.ListingStage1]:
+    return [
+        listing
+        for nearby_cell in _get_nearby_cells(cell)
+        for listing in listings_by_cell.get(nearby_cell, [])
+    ]
+
+
+def iter_listings_needing_images(
+    listings: Iterable[types.ListingStage1],
+) -> Iterator[tuple[types.ListingStage1, list[types.ListingStage1]]]:
+    # Yields each listing along with the listings whose first images are needed to tell whether it's a
+    # duplicate of an earlier one: none if there's no earlier listing nearby, otherwise it and any
+    # nearby listings that haven't been yielded as needing images before. Listings with nothing nearby
+    # can't be duplicates, so their images never need fetching.
+    listings_by_cell: dict[_Cell, list[types.ListingStage1]] = {}
+    listing_ids_needing_images = set()
+    for listing in listings:
+        cell = _get_cell(listing.latlng)
+        nearby_listings = _get_nearby_listings(listings_by_cell, cell)
+        listings_needing_images = []
+        if nearby_listings:
+            for needed_listing in [*nearby_listings, listing]:
+                if needed_listing.listing_id not in listing_ids_needing_images:
+                    listing_ids_needing_images.add(needed_listing.listing_id)
+                    listings_needing_images.append(needed_listing)
+        listings_by_cell.setdefault(cell, []).append(listing)
+        yield listing, listings_needing_images
+
+
+class DuplicateGrouper:
+    # Listings count as duplicates if they're nearby and most of their first images match (see
+    # _is_same_listing).
+    # Each group is represented by the first listing added to it, with the others appended to its
+    # `duplicate_listings` as they're added - possibly after the representative has been passed on.
+    # `get_first_images` is only called for listings in iter_listings_needing_images, and at most
+    # once per listing.
+
+    def __init__(self, get_first_images: Callable[[types.ListingStage1], list[bytes]]):
+        self._get_first_images = get_first_images
+        self._group_listings_by_cell: dict[_Cell, list[types.ListingStage1]] = {}
+        self._image_hashes_by_listing_id: dict[types.ListingID, list[_ImageHash]] = {}
+
+    def _get_image_hashes(self, listing: types.ListingStage1) -> list[_ImageHash]:
+        if listing.listing_id not in self._image_hashes_by_listing_id:
+            self._image_hashes_by_listing_id[listing.listing_id] = [
+                _hash_image(image) for image in self._get_first_images(listing)
+            ]
+        return self._image_hashes_by_listing_id[listing.listing_id]
+
+    def add(self, listing: types.ListingStage1) -> types.ListingStage1 | None:
+        # Returns the listing if it starts a new group, or None if it's a duplicate.
+        cell = _get_cell(listing.latlng)
+        for group_listing in _get_nearby_listings(self._group_listings_by_cell, cell):
+            if _is_same_listing(
+                self._get_image_hashes(listing), self._get_image_hashes(group_listing)
+            ):
+                group_listing.duplicate_listings.append(
+                    types.DuplicateListing(
+                        listing_id=listing.listing_id,
+                        listing_url=listing.listing_url,
+                        price_str=listing.price_str,
+                        agent=listing.agent,
+                    )
+                )
+                return None
+        group_listing = dataclasses.replace(listing, duplicate_listings=[])
+        self._group_listings_by_cell.setdefault(cell, []).append(group_listing)
+        return group_listing
+
+
+def iter_group_duplicate_listings(
+    listings: Iterable[types.ListingStage1],
+    fetch_first_images: Callable[[types.ListingStage1], list[bytes]],
+) -> Iterator[types.ListingStage1]:
+    # Yields the listing representing each group of duplicates, fetching the first images that are
+    # needed in parallel.
+    first_images_by_listing_id = {}
+
+    @metrics_utils.busy(metrics_utils.DEDUPLICATION)
+    def fetch_needed_first_images(
+        listing_and_listings_needing_images: tuple[
+            types.ListingStage1, list[types.ListingStage1]
+        ]
+    ) -> types.ListingStage1:
+        listing, listings_needing_images = listing_and_listings_needing_images
+        for needed_listing in listings_needing_images:
+            first_images_by_listing_id[needed_listing.listing_id] = fetch_first_images(
+                needed_listing
+            )
+        return listing
+
+    # Since results come out in order, by the time the grouper sees a listing, the images it needs
+    # have been fetched. It only needs each listing's images once, so drop them once used.
+    grouper = DuplicateGrouper(
+        lambda listing: first_images_by_listing_id.pop(listing.listing_id)
+    )
+    for listing in pipeline_utils.parallel_map(
+        fetch_needed_first_images, iter_listings_needing_images(listings)
+    ):
+        with metrics_utils.busy(metrics_utils.DEDUPLICATION):
+            group_listing = grouper.add(listing)
+        if group_listing is not None:
+            yield group_listing
+
+
+def group_duplicate_listings(
+    listings: list[types.ListingStage1],
+    fetch_first_images: Callable[[types.ListingStage1], list[bytes]],
+) -> list[types.ListingStage1]:
+    return list(iter_group_duplicate_listings(listings, fetch_first_images))
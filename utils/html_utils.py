@@ -91,6 +91,19 @@ def write_html(listings: list[types.ListingStage3]):
             f"{listing_with_commute.transit_commute.duration_mins:.0f} min</h3>\n"
         )
         html += f"<h3>{listing_with_commute.added_or_reduced}</h3>\n"
+        if listing_with_commute.duplicate_listings:
+            html += "<h4>Listed by:</h4>\n<ul>\n"
+            html += (
+                f"<li>{listing_with_commute.agent}: "
+                f"{listing_with_commute.price_str}</li>\n"
+            )
+            for duplicate_listing in listing_with_commute.duplicate_listings:
+                html += (
+                    f"<li>{duplicate_listing.agent}: {duplicate_listing.price_str} "
+                    f"(<a href={duplicate_listing.listing_url}>"
+                    f"Listing {duplicate_listing.listing_id}</a>)</li>\n"
+                )
+            html += "</ul>\n"
         html += '<div class="image-container">\n'
         for image_bytes in listing_with_commute.images:
             image_base64 = base64.b64encode(image_bytes).decode()
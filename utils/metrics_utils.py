@@ -0,0 +1,197 @@
+import contextlib
+import dataclasses
+import json
+import pathlib
+import resource
+import sys
+import threading
+import time
+
+# Stage names, in pipeline order.
+SEARCH_PAGES = "search_pages"
+DETAIL_PAGES = "detail_pages"
+PARSING = "parsing"
+DEDUPLICATION = "deduplication"
+COMMUTES = "commutes"
+IMAGES = "images"
+HTML = "html"
+# With --pipeline the stages overlap, so their wall and CPU times are only measured as a whole, and
+# each stage only has a busy time.
+PIPELINE = "pipeline"
+
+
+@dataclasses.dataclass()
+class StageStats:
+    # None if the stage wasn't timed as a whole, e.g. with --pipeline.
+    wall_time_secs: float | None = None
+    # Process-wide CPU time (including any worker threads) while the stage was running.
+    cpu_time_secs: float | None = None
+    # Time spent in the stage's own work, e.g. fetching and caching a listing's page, summed over
+    # the threads doing it. So it can exceed the wall time, but unlike it, is measured with
+    # --pipeline too.
+    busy_time_secs: float = 0.0
+    num_requests: int = 0
+    num_retries: int = 0
+    # As received, i.e. before decompression.
+    bytes_transferred: int = 0
+    # Size of cached responses the server confirmed were unchanged, which we didn't have to download.
+    bytes_saved: int = 0
+
+
+@dataclasses.dataclass()
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    # Expired entries which the server confirmed were unchanged. These are included in hits.
+    revalidations: int = 0
+
+    @property
+    def hit_ratio(self) -> float | None:
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+
+# Counters are updated from fetch worker threads, so all access goes through this lock.
+_lock = threading.Lock()
+_stats_by_stage: dict[str, StageStats] = {}
+_stats_by_cache: dict[str, CacheStats] = {}
+
+
+def _stage_stats(stage: str) -> StageStats:
+    return _stats_by_stage.setdefault(stage, StageStats())
+
+
+def _cache_stats(cache: str) -> CacheStats:
+    return _stats_by_cache.setdefault(cache, CacheStats())
+
+
+@contextlib.contextmanager
+def timed(stage: str):
+    start_wall_time = time.perf_counter()
+    start_cpu_time = time.process_time()
+    try:
+        yield
+    finally:
+        wall_time = time.perf_counter() - start_wall_time
+        cpu_time = time.process_time() - start_cpu_time
+        with _lock:
+            stats = _stage_stats(stage)
+            stats.wall_time_secs = (stats.wall_time_secs or 0.0) + wall_time
+            stats.cpu_time_secs = (stats.cpu_time_secs or 0.0) + cpu_time
+
+
+@contextlib.contextmanager
+def busy(stage: str):
+    # Wrap the stage's work for each listing in this, rather than the whole stage, so that it's
+    # measured the same way whether or not the stages overlap.
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        busy_time = time.perf_counter() - start_time
+        with _lock:
+            _stage_stats(stage).busy_time_secs += busy_time
+
+
+def record_request(stage: str, num_bytes: int) -> None:
+    with _lock:
+        stats = _stage_stats(stage)
+        stats.num_requests += 1
+        stats.bytes_transferred += num_bytes
+
+
+def record_retry(stage: str) -> None:
+    with _lock:
+        _stage_stats(stage).num_retries += 1
+
+
+def record_cache_hits(cache: str, num_hits: int) -> None:
+    with _lock:
+        _cache_stats(cache).hits += num_hits
+
+
+def record_cache_misses(cache: str, num_misses: int) -> None:
+    with _lock:
+        _cache_stats(cache).misses += num_misses
+
+
+def _get_peak_rss_bytes() -> int:
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS but kilobytes on Linux.
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def record_cache_revalidation(cache: str, stage: str, num_bytes_saved: int) -> None:
+    with _lock:
+        stats = _cache_stats(cache)
+        # The lookup was counted as a miss, since the entry had expired, but we ended up using it.
+        stats.misses -= 1
+        stats.hits += 1
+        stats.revalidations += 1
+        _stage_stats(stage).bytes_saved += num_bytes_saved
+
+
+def get_report() -> dict:
+    with _lock:
+        return {
+            "peak_rss_bytes": _get_peak_rss_bytes(),
+            "stages": {
+                stage: dataclasses.asdict(stats)
+                for stage, stats in _stats_by_stage.items()
+            },
+            "caches": {
+                cache: {**dataclasses.asdict(stats), "hit_ratio": stats.hit_ratio}
+                for cache, stats in _stats_by_cache.items()
+            },
+        }
+
+
+def _write_atomically(path: pathlib.Path, text: str) -> None:
+    # The Prometheus textfile collector may read the file at any time, so never leave it half-written.
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(text)
+    tmp_path.rename(path)
+
+
+def write_json_report(path: pathlib.Path) -> None:
+    _write_atomically(path, json.dumps(get_report(), indent=2))
+    print(f"Wrote run report to {path}")
+
+
+def write_prometheus_textfile(path: pathlib.Path) -> None:
+    report = get_report()
+    lines = [
+        "# HELP rightermove_peak_rss_bytes Peak resident set size of the run.",
+        "# TYPE rightermove_peak_rss_bytes gauge",
+        f"rightermove_peak_rss_bytes {report['peak_rss_bytes']}",
+    ]
+    stage_metrics = (
+        ("wall_time_secs", "stage_wall_time_seconds", "Wall time spent in stage."),
+        ("cpu_time_secs", "stage_cpu_time_seconds", "CPU time spent in stage."),
+        ("busy_time_secs", "stage_busy_time_seconds", "Time spent in stage's work."),
+        ("num_requests", "stage_requests", "HTTP requests made by stage."),
+        ("num_retries", "stage_retries", "HTTP requests retried by stage."),
+        ("bytes_transferred", "stage_bytes", "Bytes downloaded by stage."),
+        ("bytes_saved", "stage_bytes_saved", "Bytes not downloaded thanks to 304s."),
+    )
+    for field, metric_name, help_text in stage_metrics:
+        lines.append(f"# HELP rightermove_{metric_name} {help_text}")
+        lines.append(f"# TYPE rightermove_{metric_name} gauge")
+        for stage, stats in report["stages"].items():
+            # Stages that weren't timed as a whole have no wall or CPU time.
+            if stats[field] is not None:
+                lines.append(
+                    f'rightermove_{metric_name}{{stage="{stage}"}} {stats[field]}'
+                )
+    cache_metrics = (
+        ("hits", "cache_hits", "Lookups served from cache."),
+        ("misses", "cache_misses", "Lookups not served from cache."),
+        ("revalidations", "cache_revalidations", "Expired entries found unchanged."),
+    )
+    for field, metric_name, help_text in cache_metrics:
+        lines.append(f"# HELP rightermove_{metric_name} {help_text}")
+        lines.append(f"# TYPE rightermove_{metric_name} gauge")
+        for cache, stats in report["caches"].items():
+            lines.append(f'rightermove_{metric_name}{{cache="{cache}"}} {stats[field]}')
+    _write_atomically(path, "\n".join(lines) + "\n")
+    print(f"Wrote Prometheus metrics to {path}")
@@ -0,0 +1,100 @@
+import collections
+import concurrent.futures
+import dataclasses
+import queue
+import threading
+from typing import Callable, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+U = TypeVar("U")
+
+# How many items a stage can get ahead of the next one.
+MAX_BUFFERED = 64
+NUM_WORKERS = 16
+
+
+class _Done:
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class _Failed:
+    exception: BaseException
+
+
+def _put(output_queue: queue.Queue, item, stopped: threading.Event) -> bool:
+    # Returns False if the consumer stopped before there was room for the item.
+    while not stopped.is_set():
+        try:
+            output_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _produce(
+    items: Iterable[T], output_queue: queue.Queue, stopped: threading.Event
+) -> None:
+    iterator = iter(items)
+    try:
+        for item in iterator:
+            if not _put(output_queue, item, stopped):
+                break
+        else:
+            _put(output_queue, _Done(), stopped)
+    except BaseException as e:
+        _put(output_queue, _Failed(e), stopped)
+    finally:
+        # If the consumer stopped early, e.g. on Ctrl-C, this lets a generator clean up, e.g. so that
+        # parallel_map cancels its pending calls.
+        if hasattr(iterator, "close"):
+            iterator.close()
+
+
+def buffered(items: Iterable[T], max_buffered: int = MAX_BUFFERED) -> Iterator[T]:
+    # Consumes `items` in a background thread, so that the consumer of the returned iterator can work
+    # on one item while the next ones are being produced. The thread blocks once the consumer falls
+    # `max_buffered` items behind, and stops once the consumer does.
+    output_queue = queue.Queue(maxsize=max_buffered)
+    stopped = threading.Event()
+    threading.Thread(
+        target=_produce, args=(items, output_queue, stopped), daemon=True
+    ).start()
+    try:
+        while True:
+            item = output_queue.get()
+            if isinstance(item, _Done):
+                return
+            elif isinstance(item, _Failed):
+                raise item.exception
+            else:
+                yield item
+    finally:
+        stopped.set()
+
+
+def parallel_map(
+    fn: Callable[[T], U],
+    items: Iterable[T],
+    num_workers: int = NUM_WORKERS,
+    max_buffered: int = MAX_BUFFERED,
+) -> Iterator[U]:
+    # Like map, but with up to `num_workers` calls to `fn` in flight at a time. Results are yielded in
+    # the same order as `items`, so that later stages see the same order on every run; a slow call
+    # holds back up to `max_buffered` results after it.
+
+    def ordered_results() -> Iterator[U]:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_workers)
+        try:
+            futures = collections.deque()
+            for item in items:
+                futures.append(executor.submit(fn, item))
+                if len(futures) >= max_buffered:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    return buffered(ordered_results(), max_buffered)
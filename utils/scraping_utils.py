@@ -1,14 +1,18 @@
-import concurrent.futures
-import dataclasses
+import hashlib
 import json
+import os
 import pathlib
 import pprint
 import sys
-from typing import TypeVar
+import time
+from typing import Callable, Iterator, TypeVar
 
 import requests
 import tqdm
 
+from utils import cache_utils
+from utils import metrics_utils
+from utils import pipeline_utils
 from utils import types
 
 _USER_AGENT_HEADER = {
@@ -20,22 +24,150 @@ _USER_AGENT_HEADER = {
     )
 }
 
-_RAW_DATA_CACHE_PATH = pathlib.Path("raw_data_cache.json")
-_IMAGES_CACHE_PATH = pathlib.Path("images_cache/")
+# Overridable so that benchmarks can point us at a local stand-in.
+_RIGHTMOVE_URL = os.environ.get("RIGHTMOVE_URL", "https://www.rightmove.co.uk")
+# Statuses on which we assume the request might succeed if we try again.
+_RETRIABLE_STATUSES = {429, 500, 502, 503, 504}
+_MAX_ATTEMPTS = 5
+
+# Where raw data and images were cached before caches/ existed.
+_LEGACY_RAW_DATA_CACHE_PATH = pathlib.Path("raw_data_cache.json")
+_LEGACY_IMAGES_CACHE_PATH = pathlib.Path("images_cache/")
 
 T = TypeVar("T")
+U = TypeVar("U")
+
+
+def _search_params_key(search_params: types.SearchParams) -> str:
+    return json.dumps(search_params, sort_keys=True)
+
+
+def _get(
+    url: str, stage: str, headers: dict[str, str] | None = None, **kwargs
+) -> requests.Response:
+    headers = {**_USER_AGENT_HEADER, **(headers or {})}
+    for attempt in range(_MAX_ATTEMPTS):
+        if attempt > 0:
+            metrics_utils.record_retry(stage)
+            time.sleep(0.5 * 2 ** (attempt - 1))
+        response = requests.get(url, headers=headers, **kwargs)
+        # What we actually received, which may be compressed, rather than len(response.content).
+        metrics_utils.record_request(stage, response.raw.tell())
+        if response.status_code not in _RETRIABLE_STATUSES:
+            break
+    return response
+
+
+def _results_page_cache_key(
+    search_params: dict[str, int | str | float],
+    listing_index: int,
+) -> str:
+    return json.dumps(
+        {"search_params": search_params, "index": listing_index}, sort_keys=True
+    )
+
+
+def _get_validators(url: str) -> dict | None:
+    validators = cache_utils.VALIDATORS.get_stale(url)
+    if validators is None:
+        return None
+    return json.loads(validators)
+
+
+def _get_conditional_headers(url: str) -> dict[str, str]:
+    validators = _get_validators(url)
+    if validators is None:
+        return {}
+    headers = {}
+    if validators["etag"] is not None:
+        headers["If-None-Match"] = validators["etag"]
+    if validators["last_modified"] is not None:
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+def _get_num_bytes_saved(fetch_result: types.FetchResult, stale_content: bytes) -> int:
+    # How much we'd have received without the 304. Falls back to the decompressed size if the
+    # validators have since been evicted.
+    validators = _get_validators(fetch_result.url)
+    if validators is None:
+        return len(stale_content)
+    return validators["num_bytes_received"]
+
+
+def _cache_validators(fetch_result: types.FetchResult) -> None:
+    if fetch_result.etag is None and fetch_result.last_modified is None:
+        return
+    num_bytes_received = fetch_result.num_bytes_received
+    if fetch_result.not_modified:
+        # A 304 has no body, so keep the size of the response it stood in for.
+        validators = _get_validators(fetch_result.url)
+        num_bytes_received = validators["num_bytes_received"] if validators else 0
+    cache_utils.VALIDATORS.put(
+        fetch_result.url,
+        json.dumps(
+            {
+                "etag": fetch_result.etag,
+                "last_modified": fetch_result.last_modified,
+                "num_bytes_received": num_bytes_received,
+            }
+        ).encode(),
+    )
+
+
+def _fetch(url: str, stage: str, conditional: bool) -> types.FetchResult:
+    headers = _get_conditional_headers(url) if conditional else {}
+    response = _get(url, stage, headers=headers)
+    return types.FetchResult(
+        url=url,
+        content=response.content,
+        num_bytes_received=response.raw.tell(),
+        status_code=response.status_code,
+        not_modified=bool(headers) and response.status_code == 304,
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+    )
+
+
+def _is_ok(fetch_result: types.FetchResult) -> bool:
+    # Anything else (e.g. a 404 for a delisted property, or a 503 we gave up retrying) must not be
+    # cached, or later runs would keep reusing the error page instead of trying again.
+    return fetch_result.status_code == 200 or fetch_result.not_modified
 
 
+def _print_failed(fetch_result: types.FetchResult) -> None:
+    print(
+        f"Warning: got status {fetch_result.status_code} for {fetch_result.url}; skipping it"
+    )
+
+
+def _parallel_map(fn: Callable[[T], U], items: list[T]) -> list[U]:
+    # For running a stage on all listings at once: the same per-listing function as --pipeline mode
+    # uses, but waiting for all the results, with a progress bar.
+    return list(
+        tqdm.tqdm(
+            pipeline_utils.parallel_map(fn, items), total=len(items), unit="listing"
+        )
+    )
+
+
+@metrics_utils.busy(metrics_utils.SEARCH_PAGES)
 def _fetch_results_page(
     search_params: dict[str, int | str | float],
     listing_index: int,
 ) -> types.ListingDict:
-    response = requests.get(
-        "https://www.rightmove.co.uk/api/_search",
+    # Cached so that an interrupted scrape can be resumed without refetching pages.
+    cache_key = _results_page_cache_key(search_params, listing_index)
+    cached_page = cache_utils.SEARCH_PAGES.get(cache_key)
+    if cached_page is not None:
+        return types.ListingDict(json.loads(cached_page))
+    response = _get(
+        f"{_RIGHTMOVE_URL}/api/_search",
+        metrics_utils.SEARCH_PAGES,
         params={**search_params, "index": listing_index},
-        headers=_USER_AGENT_HEADER,
     )
     assert response.status_code == 200, response.content
+    cache_utils.SEARCH_PAGES.put(cache_key, response.content)
     return types.ListingDict(response.json())
 
 
@@ -69,60 +201,97 @@ def _fetch_listing_dicts(
     return listing_dicts
 
 
+def iter_listing_dicts(
+    search_params: types.SearchParams,
+) -> Iterator[types.ListingDict]:
+    listing_index = 0
+    while True:
+        results_page = _fetch_results_page(search_params, listing_index)
+        yield from results_page["properties"]
+        listing_index = results_page["pagination"].get("next", None)
+        if not listing_index:
+            break
+
+
+def _listing_page_url(listing_id: types.ListingID) -> str:
+    return f"{_RIGHTMOVE_URL}/properties/{listing_id}"
+
+
+def _cache_listing_page(
+    listing_id: types.ListingID,
+    fetch_result: types.FetchResult,
+    stale_html: bytes | None,
+) -> bytes | None:
+    # Returns None if the page couldn't be fetched.
+    if not _is_ok(fetch_result):
+        _print_failed(fetch_result)
+        return None
+    if fetch_result.not_modified:
+        cache_utils.LISTING_PAGES.refresh(str(listing_id))
+        metrics_utils.record_cache_revalidation(
+            cache_utils.LISTING_PAGES.name,
+            metrics_utils.DETAIL_PAGES,
+            _get_num_bytes_saved(fetch_result, stale_html),
+        )
+        html = stale_html
+    else:
+        cache_utils.LISTING_PAGES.put(str(listing_id), fetch_result.content)
+        html = fetch_result.content
+    _cache_validators(fetch_result)
+    return html
+
+
+@metrics_utils.busy(metrics_utils.DETAIL_PAGES)
+def fetch_listing_page(listing_id: types.ListingID) -> str | None:
+    cached_html = cache_utils.LISTING_PAGES.get(str(listing_id))
+    if cached_html is not None:
+        return cached_html.decode()
+    stale_html = cache_utils.LISTING_PAGES.get_stale(str(listing_id))
+    fetch_result = _fetch(
+        _listing_page_url(listing_id),
+        metrics_utils.DETAIL_PAGES,
+        conditional=stale_html is not None,
+    )
+    html = _cache_listing_page(listing_id, fetch_result, stale_html)
+    return html.decode() if html is not None else None
+
+
 def _fetch_listing_pages(
     listing_ids: list[types.ListingID],
 ) -> dict[types.ListingID, str]:
-    fetch_results_by_listing_id = _parallel_fetch(
-        {
-            listing_id: [f"https://www.rightmove.co.uk/properties/{listing_id}"]
-            for listing_id in listing_ids
-        }
-    )
+    # Cached as they arrive, so that an interrupted scrape can be resumed without refetching pages.
+    listing_ids = list(dict.fromkeys(listing_ids))
+    listing_htmls = _parallel_map(fetch_listing_page, listing_ids)
+    # Pages we couldn't fetch are left out.
     return {
-        listing_id: fetch_results_by_listing_id[listing_id][0].content.decode()
-        for listing_id in listing_ids
+        listing_id: listing_html
+        for listing_id, listing_html in zip(listing_ids, listing_htmls)
+        if listing_html is not None
     }
 
 
-def _parallel_fetch(
-    urls_by_key: dict[T, list[str]]
-) -> dict[T, list[types.FetchResult]]:
-    if not urls_by_key:
-        return {}
-    fetch_results_by_key = {}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-        key_by_future = {}
-        for key, urls in urls_by_key.items():
-            future = executor.submit(
-                lambda lambda_urls=tuple(urls): [
-                    types.FetchResult(
-                        url=url,
-                        content=requests.get(url, headers=_USER_AGENT_HEADER).content,
-                    )
-                    for url in lambda_urls
-                ],
-            )
-            key_by_future[future] = key
-        for future in tqdm.tqdm(
-            concurrent.futures.as_completed(key_by_future),
-            unit="listing",
-            total=len(key_by_future),
-        ):
-            key = key_by_future[future]
-            fetch_results_by_key[key] = future.result()
-    return fetch_results_by_key
-
-
 def scrape_raw_data(search_params: types.SearchParams) -> types.RawScrapeData:
     print("Search parameters:")
     pprint.pprint(search_params)
 
     print("Fetching listings summary...")
-    listing_dicts = _fetch_listing_dicts(search_params)
+    with metrics_utils.timed(metrics_utils.SEARCH_PAGES):
+        listing_dicts = _fetch_listing_dicts(search_params)
     listing_ids = [types.ListingID(int(d["id"])) for d in listing_dicts]
 
     print("Fetching individual listings...")
-    listing_html_by_listing_id = _fetch_listing_pages(listing_ids)
+    with metrics_utils.timed(metrics_utils.DETAIL_PAGES):
+        listing_html_by_listing_id = _fetch_listing_pages(listing_ids)
+    if len(listing_html_by_listing_id) < len(set(listing_ids)):
+        print(
+            f"Warning: skipping {len(set(listing_ids)) - len(listing_html_by_listing_id)} "
+            "listings whose pages couldn't be fetched\n"
+        )
+        listing_dicts = [
+            d
+            for d in listing_dicts
+            if types.ListingID(int(d["id"])) in listing_html_by_listing_id
+        ]
 
     return types.RawScrapeData(
         search_params=search_params,
@@ -131,106 +300,188 @@ def scrape_raw_data(search_params: types.SearchParams) -> types.RawScrapeData:
     )
 
 
+def clear_cached_results_pages(search_params: types.SearchParams) -> None:
+    # Called once a scrape has completed, so there's nothing left to resume.
+    listing_index = 0
+    while True:
+        cache_key = _results_page_cache_key(search_params, listing_index)
+        cached_page = cache_utils.SEARCH_PAGES.get_stale(cache_key)
+        if cached_page is None:
+            break
+        cache_utils.SEARCH_PAGES.delete(cache_key)
+        listing_index = json.loads(cached_page)["pagination"].get("next", None)
+        if not listing_index:
+            break
+
+
 def save_raw_data_cache(data: types.RawScrapeData) -> None:
-    _RAW_DATA_CACHE_PATH.write_text(
+    cache_utils.RAW_DATA.put(
+        _search_params_key(data.search_params),
         json.dumps(
             {
-                "search_params": data.search_params,
                 "listing_dicts": data.listing_dicts,
                 "listing_html_by_listing_id": data.listing_html_by_listing_id,
             }
-        )
+        ).encode(),
     )
 
 
-def load_raw_data_cache(
-    search_params_from_arguments: types.SearchParams,
-) -> types.RawScrapeData:
-    cache = json.loads(_RAW_DATA_CACHE_PATH.read_text())
-    cache_search_params = cache["search_params"]
-    if cache_search_params != search_params_from_arguments:
+def load_raw_data_cache(search_params: types.SearchParams) -> types.RawScrapeData:
+    cached_data = cache_utils.RAW_DATA.get(_search_params_key(search_params))
+    if cached_data is None:
         print(
-            f"Search parameters from cache:\n\n{cache_search_params}\n\n"
-            f"do not match parameters from arguments:\n\n{search_params_from_arguments}",
+            f"No raw data cached for search parameters:\n\n{search_params}",
             file=sys.stderr,
         )
         exit(1)
+    cache = json.loads(cached_data)
     listing_dicts = cache["listing_dicts"]
     listing_html_by_listing_id = cache["listing_html_by_listing_id"]
     listing_html_by_listing_id = {
         types.ListingID(int(l_id)): h for l_id, h in listing_html_by_listing_id.items()
     }
     return types.RawScrapeData(
-        search_params=cache_search_params,
+        search_params=search_params,
         listing_dicts=listing_dicts,
         listing_html_by_listing_id=listing_html_by_listing_id,
     )
 
 
-def _load_cached_images() -> dict[types.ListingID, list[bytes]]:
-    image_paths = _IMAGES_CACHE_PATH.glob("*")
-    listing_ids = [types.ListingID(int(p.stem.split("_")[0])) for p in image_paths]
-    listing_ids = [types.ListingID(int(l_id)) for l_id in listing_ids]
-    images_by_listing_id = {}
-    for listing_id in listing_ids:
-        listing_image_paths = pathlib.Path("images_cache").glob(f"{listing_id}_*")
-        images = [p.read_bytes() for p in listing_image_paths]
-        images_by_listing_id[listing_id] = images
-    return images_by_listing_id
+def _import_legacy_images(listing_dicts: list[types.ListingDict]) -> int:
+    # images_cache/ named each image after its listing ID and its index in the listing's sorted
+    # image URLs, so images can only be matched back to their URLs for listings we still have.
+    num_imported = 0
+    for listing_dict in listing_dicts:
+        urls = sorted(im["srcUrl"] for im in listing_dict["propertyImages"]["images"])
+        for image_num, url in enumerate(urls):
+            path = _LEGACY_IMAGES_CACHE_PATH / f"{listing_dict['id']}_{image_num}.jpeg"
+            if not path.exists():
+                continue
+            image = path.read_bytes()
+            image_hash = hashlib.sha256(image).hexdigest()
+            cache_utils.IMAGES.put(image_hash, image)
+            cache_utils.IMAGE_HASHES.put(url, image_hash.encode())
+            num_imported += 1
+    return num_imported
+
+
+def import_legacy_caches() -> None:
+    # Moves raw_data_cache.json, and the images in images_cache/ of the listings in it, into
+    # caches/. The old files are renamed rather than deleted, so this only happens once.
+    if not _LEGACY_RAW_DATA_CACHE_PATH.exists():
+        return
+    cache = json.loads(_LEGACY_RAW_DATA_CACHE_PATH.read_text())
+    save_raw_data_cache(
+        types.RawScrapeData(
+            search_params=cache["search_params"],
+            listing_dicts=cache["listing_dicts"],
+            listing_html_by_listing_id=cache["listing_html_by_listing_id"],
+        )
+    )
+    num_images = 0
+    if _LEGACY_IMAGES_CACHE_PATH.exists():
+        num_images = _import_legacy_images(cache["listing_dicts"])
+        _LEGACY_IMAGES_CACHE_PATH.rename(f"{_LEGACY_IMAGES_CACHE_PATH}.imported")
+    _LEGACY_RAW_DATA_CACHE_PATH.rename(f"{_LEGACY_RAW_DATA_CACHE_PATH}.imported")
+    print(
+        f"Imported raw data for {len(cache['listing_dicts'])} listings and {num_images} "
+        f"images from {_LEGACY_RAW_DATA_CACHE_PATH} and {_LEGACY_IMAGES_CACHE_PATH}\n"
+    )
+
 
+def _get_cached_image(url: str) -> bytes | None:
+    image_hash = cache_utils.IMAGE_HASHES.get(url)
+    if image_hash is None:
+        return None
+    return cache_utils.IMAGES.get(image_hash.decode())
 
-def _save_cached_images(
-    image_by_listing_id: dict[types.ListingID, list[bytes]]
+
+def _get_stale_cached_image(url: str) -> bytes | None:
+    image_hash = cache_utils.IMAGE_HASHES.get_stale(url)
+    if image_hash is None:
+        return None
+    return cache_utils.IMAGES.get_stale(image_hash.decode())
+
+
+def _cache_image(
+    fetch_result: types.FetchResult,
+    stale_image: bytes | None,
+    stage: str,
 ) -> None:
-    for listing_id, images in image_by_listing_id.items():
-        for image_num, image in enumerate(images):
-            path = _IMAGES_CACHE_PATH / f"{listing_id}_{image_num}.jpeg"
-            path.write_bytes(image)
+    if not _is_ok(fetch_result):
+        _print_failed(fetch_result)
+        return
+    if fetch_result.not_modified:
+        image_hash = hashlib.sha256(stale_image).hexdigest()
+        cache_utils.IMAGE_HASHES.refresh(fetch_result.url)
+        cache_utils.IMAGES.refresh(image_hash)
+        metrics_utils.record_cache_revalidation(
+            cache_utils.IMAGE_HASHES.name,
+            stage,
+            _get_num_bytes_saved(fetch_result, stale_image),
+        )
+    else:
+        image_hash = hashlib.sha256(fetch_result.content).hexdigest()
+        cache_utils.IMAGES.put(image_hash, fetch_result.content)
+        cache_utils.IMAGE_HASHES.put(fetch_result.url, image_hash.encode())
+    _cache_validators(fetch_result)
+
+
+def _fetch_image(url: str, stage: str) -> bytes | None:
+    # Returns None if the image couldn't be fetched. Cached as soon as it arrives, so that an
+    # interrupted run doesn't refetch it.
+    cached_image = _get_cached_image(url)
+    if cached_image is not None:
+        return cached_image
+    # An expired image, which we can keep using if the server says it hasn't changed.
+    stale_image = _get_stale_cached_image(url)
+    fetch_result = _fetch(url, stage, conditional=stale_image is not None)
+    _cache_image(fetch_result, stale_image, stage)
+    if not _is_ok(fetch_result):
+        return None
+    return stale_image if fetch_result.not_modified else fetch_result.content
+
+
+def fetch_first_images(
+    listing: types.ListingStage1,
+    num_images: int,
+) -> list[bytes]:
+    images = [
+        _fetch_image(url, metrics_utils.DEDUPLICATION)
+        for url in listing.image_urls[:num_images]
+    ]
+    return [image for image in images if image is not None]
+
+
+def _with_images(
+    listing: types.ListingStage2, images: list[bytes]
+) -> types.ListingStage3:
+    return types.ListingStage3(
+        listing_id=listing.listing_id,
+        listing_url=listing.listing_url,
+        title=listing.title,
+        image_urls=listing.image_urls,
+        price_str=listing.price_str,
+        added_or_reduced=listing.added_or_reduced,
+        tenancy_minimum_months=listing.tenancy_minimum_months,
+        latlng=listing.latlng,
+        agent=listing.agent,
+        duplicate_listings=listing.duplicate_listings,
+        bicycling_commute=listing.bicycling_commute,
+        transit_commute=listing.transit_commute,
+        images=images,
+    )
+
+
+@metrics_utils.busy(metrics_utils.IMAGES)
+def add_listing_images(listing: types.ListingStage2) -> types.ListingStage3:
+    images = [
+        _fetch_image(url, metrics_utils.IMAGES) for url in sorted(listing.image_urls)
+    ]
+    return _with_images(listing, [image for image in images if image is not None])
 
 
 def add_images(
     listings: list[types.ListingStage2],
 ) -> list[types.ListingStage3]:
-    cached_images_by_listing_id = _load_cached_images()
-    print(f"Loaded images for {len(cached_images_by_listing_id)} listings from cache")
-
-    urls_to_fetch_by_listing_id = {}
-    for listing in listings:
-        listing_id = listing.listing_id
-        if listing_id in cached_images_by_listing_id:
-            continue
-        urls_to_fetch_by_listing_id[listing_id] = sorted(listing.image_urls)
-    fetch_results_by_listing_id = _parallel_fetch(urls_to_fetch_by_listing_id)
-    print(f"Fetched images for {len(urls_to_fetch_by_listing_id)} listings\n")
-    fetched_images_by_listing_id = {
-        listing_id: [fetch_result.content for fetch_result in fetch_results]
-        for listing_id, fetch_results in fetch_results_by_listing_id.items()
-    }
-    images_by_listing_id = {
-        **cached_images_by_listing_id,
-        **fetched_images_by_listing_id,
-    }
-    _save_cached_images(images_by_listing_id)
-
-    listings_with_images = []
-    for listing in listings:
-        listing_id = listing.listing_id
-        images = images_by_listing_id[listing_id]
-        listings_with_images.append(
-            types.ListingStage3(
-                listing_id=listing_id,
-                listing_url=listing.listing_url,
-                title=listing.title,
-                image_urls=listing.image_urls,
-                price_str=listing.price_str,
-                added_or_reduced=listing.added_or_reduced,
-                tenancy_minimum_months=listing.tenancy_minimum_months,
-                latlng=listing.latlng,
-                agent=listing.agent,
-                bicycling_commute=listing.bicycling_commute,
-                transit_commute=listing.transit_commute,
-                images=images,
-            )
-        )
-
-    return listings_with_images
+    return _parallel_map(add_listing_images, listings)
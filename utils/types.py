@@ -37,7 +37,12 @@ class Image:
 @dataclasses.dataclass(frozen=True)
 class FetchResult:
     url: str
-    content: bytes
+    content: bytes  # Empty if not_modified.
+    num_bytes_received: int  # Before decompression, so possibly less than len(content).
+    status_code: int
+    not_modified: bool = False  # True if the server responded 304 Not Modified.
+    etag: str | None = None
+    last_modified: str | None = None
 
 
 @dataclasses.dataclass(frozen=True)
@@ -46,6 +51,15 @@ class Commute:
     duration_mins: int
 
 
+@dataclasses.dataclass(frozen=True)
+class DuplicateListing:
+    # The same property listed again, usually by a different agent.
+    listing_id: ListingID
+    listing_url: str
+    price_str: str
+    agent: str
+
+
 @dataclasses.dataclass(frozen=True)
 class ListingStage1:
     listing_id: ListingID
@@ -57,6 +71,7 @@ class ListingStage1:
     tenancy_minimum_months: int | None  # None = 'not specified'
     latlng: str
     agent: str
+    duplicate_listings: list[DuplicateListing]
 
 
 @dataclasses.dataclass(frozen=True)
@@ -71,6 +86,7 @@ class ListingStage2:
     tenancy_minimum_months: int | None  # None = 'not specified'
     latlng: str
     agent: str
+    duplicate_listings: list[DuplicateListing]
 
     bicycling_commute: Commute
     transit_commute: Commute
@@ -88,6 +104,7 @@ class ListingStage3:
     tenancy_minimum_months: int | None  # None = 'not specified'
     latlng: str
     agent: str
+    duplicate_listings: list[DuplicateListing]
 
     # Fields from ListingStage2.
     bicycling_commute: Commute